@@ -0,0 +1,37 @@
+# -*- coding: utf-8 -*-
+#
+# Max-Planck-Gesellschaft zur Förderung der Wissenschaften e.V. (MPG) is
+# holder of all proprietary rights on this computer program.
+# Using this computer program means that you agree to the terms 
+# in the LICENSE file included with this software distribution. 
+# Any use not explicitly granted by the LICENSE is prohibited.
+#
+# Copyright©2019 Max-Planck-Gesellschaft zur Förderung
+# der Wissenschaften e.V. (MPG). acting on behalf of its Max Planck Institute
+# for Intelligent Systems. All rights reserved.
+#
+# For comments or questions, please email us at deca@tue.mpg.de
+# For commercial licensing contact, please contact ps-license@tuebingen.mpg.de
+
+import os, sys
+import argparse
+import numpy as np
+
+sys.path.insert(0, os.path.abspath(os.path.join(os.path.dirname(__file__), '..')))
+from decalib.utils import util
+from decalib.utils.config import cfg as deca_cfg
+
+def main(args):
+    # one-shot migration: the pickled template is loaded once and saved as plain arrays next to it
+    dense_template = util.load_dense_template(args.dense_template_path)
+    savepath = os.path.splitext(args.dense_template_path)[0] + '.npz'
+    np.savez(savepath, **dense_template)
+    print(f'-- dense template saved to {savepath}')
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Convert the pickled DECA dense mesh template to a plain .npz')
+
+    parser.add_argument('-i', '--dense_template_path', default=deca_cfg.model.dense_template_path, type=str,
+                        help='path to the pickled dense template, e.g. data/texture_data_256.npy')
+
+    main(parser.parse_args())
@@ -46,9 +46,10 @@ def video2sequence(video_path):
     return imagepath_list
 
 class TestData(Dataset):
-    def __init__(self, testpath, iscrop=True, crop_size=224, scale=1.25, face_detector='fan'):
+    def __init__(self, testpath, iscrop=True, crop_size=224, scale=1.25, face_detector='fan', pin_memory=False):
         '''
             testpath: folder, imagepath_list, image path, video path
+            pin_memory: return page-locked image tensors, so copies to the gpu can be non_blocking
         '''
         if isinstance(testpath, list):
             self.imagepath_list = testpath
@@ -67,6 +68,7 @@ class TestData(Dataset):
         self.scale = scale
         self.iscrop = iscrop
         self.resolution_inp = crop_size
+        self.pin_memory = pin_memory
         if face_detector == 'fan':
             self.face_detector = detectors.FAN()
         # elif face_detector == 'mtcnn':
@@ -143,9 +145,13 @@ class TestData(Dataset):
                                                             cfg.model.texture_image_size))
         hr_image = hr_image.transpose(2,0,1)
 
-        return {'image': torch.tensor(dst_image).float(),
+        data = {'image': torch.tensor(dst_image).float(),
                 'hr_image': torch.tensor(hr_image).float(), # used for texture mapping
                 'imagename': imagename,
                 'tform': torch.tensor(tform.params).float(),
                 'original_image': torch.tensor(image.transpose(2,0,1)).float(),
                 }
+        if self.pin_memory:
+            for key in ['image', 'hr_image', 'original_image']:
+                data[key] = data[key].pin_memory()
+        return data
@@ -25,6 +25,8 @@ from skimage.io import imread
 from skimage.transform import warp
 import cv2
 import pickle
+import hashlib
+from concurrent.futures import ThreadPoolExecutor
 from .utils.renderer import SRenderY, set_rasterizer
 from .models.encoders import ResnetEncoder
 from .models.FLAME import FLAME, FLAMETex
@@ -35,8 +37,38 @@ from .utils.tensor_cropper import transform_points
 from .datasets import datasets
 from .utils.config import cfg
 torch.backends.cudnn.benchmark = True
+# TF32 tensor cores for matmuls and convolutions on Ampere and newer, no effect on older GPUs
+torch.backends.cuda.matmul.allow_tf32 = True
+torch.backends.cudnn.allow_tf32 = True
 from torchvision.utils import save_image
 
+# the convert_dense_template.py hint is printed once per process, not per DECA instance
+_dense_template_hint_shown = False
+
+@torch.jit.script
+def _blend_texture(uv_gt, uv_texture, uv_face_eye_mask, uv_gt_mask):
+    ''' Composite the sampled image texture over the model texture inside the visible face/eye mask
+    scripted so the mask product and the blend are fused into a single kernel
+    returns (visible face/eye mask, blended texture)
+    '''
+    mask = uv_face_eye_mask*uv_gt_mask
+    return mask, torch.lerp(uv_texture[:,:3,:,:], uv_gt[:,:3,:,:], mask)
+
+@torch.jit.script
+def _shade_and_blend(albedo, uv_shading, uv_gt, uv_face_eye_mask, uv_gt_mask):
+    ''' Shade the albedo and blend it with the sampled image texture, returns (uv_texture, visible face/eye mask, uv_texture_gt)
+    '''
+    uv_texture = albedo*uv_shading
+    mask, uv_texture_gt = _blend_texture(uv_gt, uv_texture, uv_face_eye_mask, uv_gt_mask)
+    return uv_texture, mask, uv_texture_gt
+
+@torch.jit.script
+def _project(X, camera, sign):
+    ''' Orthographic projection followed by the y/z flip into image space
+    sign: [1, -1, -1]
+    '''
+    return util.batch_orth_proj(X, camera)*sign
+
 class DECA(nn.Module):
     def __init__(self, config=None, device='cuda'):
         super(DECA, self).__init__()
@@ -51,28 +83,101 @@ class DECA(nn.Module):
 
         self._create_model(self.cfg.model)
         self._setup_renderer(self.cfg.model)
+        # background writer for debug images, see _save_image_async
+        self._io_stream = None
+        self._io_executor = None
 
     def _setup_renderer(self, model_cfg):
         set_rasterizer(self.cfg.rasterizer_type)
         self.render = SRenderY(self.image_size, obj_filename=model_cfg.topology_path, uv_size=model_cfg.uv_size, uv_size_coarse=model_cfg.uv_size_coarse, rasterizer_type=self.cfg.rasterizer_type).to(self.device)
-
+        # batch-expanded (dense) faces, keyed by (name, batch_size, inference mode), see _faces
+        self._faces_cache = {}
+        # ones sampled by grid_sample to build uv_gt_mask, see _ones_like
+        self._ones_cache = None
+
+        # uv masks, displacement correction and mean texture, cached on disk per set of source files and uv resolution
+        sources = [model_cfg.face_eye_mask_path, model_cfg.face_mask_path, model_cfg.fixed_displacement_path, model_cfg.mean_tex_path]
+        sources_hash = hashlib.md5('\n'.join(os.path.abspath(path) for path in sources).encode()).hexdigest()[:8]
+        cache_path = os.path.join(os.path.dirname(model_cfg.face_eye_mask_path), 'uv_maps_{}_{}_{}.pt'.format(sources_hash, model_cfg.uv_size, model_cfg.uv_size_coarse))
+        if os.path.exists(cache_path) and all(os.path.getmtime(cache_path) >= os.path.getmtime(path) for path in sources):
+            uv_maps = torch.load(cache_path, map_location=self.device)
+        else:
+            uv_maps = self._load_uv_maps(model_cfg)
+            try:
+                torch.save(uv_maps, cache_path)
+            except (OSError, RuntimeError) as e:
+                # e.g. read-only data directory, the maps are simply rebuilt on the next run
+                print(f'could not cache uv maps to {cache_path}: {e}')
+        for key in uv_maps:
+            setattr(self, key, uv_maps[key].to(self.device))
+        # dense mesh template, for save detail mesh
+        # prefer the plain-array .npz written by convert_dense_template.py over the pickled .npy
+        dense_template_npz = os.path.splitext(model_cfg.dense_template_path)[0] + '.npz'
+        if os.path.exists(dense_template_npz):
+            with np.load(dense_template_npz) as f:
+                self.dense_template = dict(f)
+        else:
+            global _dense_template_hint_shown
+            if not _dense_template_hint_shown:
+                print(f'run convert_dense_template.py to avoid unpickling {model_cfg.dense_template_path}')
+                _dense_template_hint_shown = True
+            self.dense_template = util.load_dense_template(model_cfg.dense_template_path)
+        self._setup_dense_mesh(self.dense_template)
+
+    def _setup_dense_mesh(self, dense_template):
+        ''' Device tensors for upsampling the coarse mesh in decode
+        the dense topology and its uv layout do not depend on the input, only the vertex positions do
+        '''
+        x_coords = dense_template['x_coords']
+        y_coords = dense_template['y_coords']
+        valid_pixel_ids = dense_template['valid_pixel_ids']
+        self.dense_mesh = {
+            'valid_pixel_3d_faces': torch.from_numpy(dense_template['valid_pixel_3d_faces'].astype(np.int64)).to(self.device),
+            'valid_pixel_b_coords': torch.from_numpy(dense_template['valid_pixel_b_coords']).float().to(self.device),
+            'x_ids': torch.from_numpy(x_coords[valid_pixel_ids].astype(np.int64)).to(self.device),
+            'y_ids': torch.from_numpy(y_coords[valid_pixel_ids].astype(np.int64)).to(self.device),
+        }
+        dense_faces = dense_template['f']
+        self.dense_mesh['faces'] = torch.from_numpy(dense_faces).to(self.device).unsqueeze(0)
+
+        # Normalize UV coordinates.
+        dense_uvcoords = np.stack([x_coords.astype(int), y_coords.astype(int)], 1)
+        dense_uvcoords = torch.from_numpy(dense_uvcoords).to(self.device).unsqueeze(0) / np.max(dense_uvcoords)
+        dense_uvcoords = torch.cat([dense_uvcoords, dense_uvcoords[:,:,0:1]*0.+1.], -1) #[bz, ntv, 3]
+        self.dense_mesh['uvcoords'] = dense_uvcoords*2 - 1
+        dense_uvfaces = np.stack([valid_pixel_ids[dense_faces[:, 0]], valid_pixel_ids[dense_faces[:, 1]], valid_pixel_ids[dense_faces[:, 2]]], 1)
+        self.dense_mesh['uvfaces'] = torch.from_numpy(dense_uvfaces).to(self.device).unsqueeze(0)
+
+    def _read_uv_image(self, path, channel=None):
+        ''' Read an image as a [1,C,h,w] float tensor in [0,1]
+        channel: keep only this channel; it is sliced before the uint8 -> float conversion
+        '''
+        image = torch.from_numpy(imread(path)).permute(2,0,1)
+        if channel is not None:
+            image = image[channel:channel+1]
+        return image[None].float().div_(255.)
+
+    def _load_uv_maps(self, model_cfg):
+        ''' Load the uv masks, displacement correction and mean texture from their source files
+        returns a dict of cpu tensors resized to the configured uv resolutions
+        '''
+        uv_maps = {}
         # face mask for rendering details
-        mask = imread(model_cfg.face_eye_mask_path).astype(np.float32)/255.; mask = torch.from_numpy(mask[:,:,0])[None,None,:,:].contiguous()
-        self.uv_face_eye_mask_coarse = F.interpolate(mask, [model_cfg.uv_size_coarse, model_cfg.uv_size_coarse]).to(self.device)
-        self.uv_face_eye_mask = F.interpolate(mask, [model_cfg.uv_size, model_cfg.uv_size]).to(self.device)
+        mask = self._read_uv_image(model_cfg.face_eye_mask_path, channel=0)
+        uv_maps['uv_face_eye_mask_coarse'] = F.interpolate(mask, [model_cfg.uv_size_coarse, model_cfg.uv_size_coarse])
+        uv_maps['uv_face_eye_mask'] = F.interpolate(mask, [model_cfg.uv_size, model_cfg.uv_size])
 
-        mask = imread(model_cfg.face_mask_path).astype(np.float32)/255.; mask = torch.from_numpy(mask[:,:,0])[None,None,:,:].contiguous()
-        self.uv_face_mask = F.interpolate(mask, [model_cfg.uv_size, model_cfg.uv_size]).to(self.device)
+        mask = self._read_uv_image(model_cfg.face_mask_path, channel=0)
+        uv_maps['uv_face_mask'] = F.interpolate(mask, [model_cfg.uv_size, model_cfg.uv_size])
         # displacement correction
         fixed_dis = np.load(model_cfg.fixed_displacement_path)
-        self.fixed_uv_dis = torch.tensor(fixed_dis).float().to(self.device)
-        self.fixed_uv_dis = F.interpolate(self.fixed_uv_dis[None, None, ...],
-                                          (self.uv_size_coarse, self.uv_size_coarse), mode='bilinear').squeeze()
+        fixed_uv_dis = torch.tensor(fixed_dis).float()
+        uv_maps['fixed_uv_dis'] = F.interpolate(fixed_uv_dis[None, None, ...],
+                                                (model_cfg.uv_size_coarse, model_cfg.uv_size_coarse), mode='bilinear').squeeze()
         # mean texture
-        mean_texture = imread(model_cfg.mean_tex_path).astype(np.float32)/255.; mean_texture = torch.from_numpy(mean_texture.transpose(2,0,1))[None,:,:,:].contiguous()
-        self.mean_texture = F.interpolate(mean_texture, [model_cfg.uv_size, model_cfg.uv_size]).to(self.device)
-        # dense mesh template, for save detail mesh
-        self.dense_template = np.load(model_cfg.dense_template_path, allow_pickle=True, encoding='latin1').item()
+        mean_texture = self._read_uv_image(model_cfg.mean_tex_path)
+        uv_maps['mean_texture'] = F.interpolate(mean_texture, [model_cfg.uv_size, model_cfg.uv_size])
+        return uv_maps
 
     def _create_model(self, model_cfg):
         # set up parameters
@@ -81,6 +186,15 @@ class DECA(nn.Module):
         self.n_cond = model_cfg.n_exp + 3 # exp + jaw pose
         self.num_list = [model_cfg.n_shape, model_cfg.n_tex, model_cfg.n_exp, model_cfg.n_pose, model_cfg.n_cam, model_cfg.n_light]
         self.param_dict = {i:model_cfg.get('n_' + i) for i in model_cfg.param_list}
+        self._param_keys = list(self.param_dict.keys())
+        self._split_sizes = [int(self.param_dict[key]) for key in self._param_keys]
+
+        # y/z flip applied after orthographic projection, see _project
+        self.register_buffer('_flip_sign', torch.tensor([1., -1., -1.], device=self.device), persistent=False)
+        # input buffer of the detail decoder, see _detail_input
+        self._detail_input_buf = None
+        # cuda graph of the encoders, see capture_graph
+        self._graph = None
 
         # encoders
         self.E_flame = ResnetEncoder(outsize=self.n_param).to(self.device) 
@@ -89,6 +203,9 @@ class DECA(nn.Module):
         self.flame = FLAME(model_cfg).to(self.device)
         if model_cfg.use_tex:
             self.flametex = FLAMETex(model_cfg).to(self.device)
+        else:
+            # constant albedo, expanded (not copied) to the batch size in decode
+            self.register_buffer('_zero_albedo', torch.zeros([1, 3, model_cfg.uv_size, model_cfg.uv_size], device=self.device), persistent=False)
         self.D_detail = Generator(latent_dim=self.n_detail+self.n_cond, out_channels=1, out_scale=model_cfg.max_z, sample_mode = 'bilinear', uv_size=self.cfg.model.uv_size_coarse).to(self.device)
         # resume model
         model_path = self.cfg.pretrained_modelpath
@@ -106,23 +223,93 @@ class DECA(nn.Module):
         self.E_flame.eval()
         self.E_detail.eval()
         self.D_detail.eval()
+        # NHWC conv weights, the matching input layout is set in encode
+        self.E_flame.to(memory_format=torch.channels_last)
+        self.E_detail.to(memory_format=torch.channels_last)
+        self.D_detail.to(memory_format=torch.channels_last)
+        if model_cfg.use_jit:
+            self._compile_model(model_path)
+
+    def _compile_model(self, model_path):
+        ''' Trace the encoders and the detail decoder with TorchScript (inference only)
+        compiled modules are cached next to the pretrained model and reloaded on later runs,
+        the traced shapes are part of the cache name since a trace bakes them in as constants
+        '''
+        image_size = self.cfg.dataset.image_size
+        example_images = torch.randn(1, 3, image_size, image_size, device=self.device).contiguous(memory_format=torch.channels_last)
+        example_latent = torch.randn(1, self.n_detail+self.n_cond, device=self.device)
+        for name, example in [('E_flame', example_images), ('E_detail', example_images), ('D_detail', example_latent)]:
+            jit_path = os.path.splitext(model_path)[0] + '_{}_{}_{}_{}_{}_jit_cl.pt'.format(name, image_size, self.n_detail, self.n_cond, self.cfg.model.uv_size_coarse)
+            if os.path.exists(jit_path) and os.path.exists(model_path) and os.path.getmtime(jit_path) >= os.path.getmtime(model_path):
+                module = torch.jit.load(jit_path, map_location=self.device)
+            else:
+                with torch.no_grad():
+                    module = torch.jit.freeze(torch.jit.trace(getattr(self, name), example))
+                if os.path.exists(model_path):
+                    torch.jit.save(module, jit_path)
+            setattr(self, name, module)
+
+    def _faces(self, batch_size, dense=False):
+        ''' Faces (or dense uv faces) of the template expanded to batch_size, cached across calls
+        keyed on inference mode too, an inference tensor can not be saved for backward outside it
+        '''
+        name = 'dense_faces' if dense else 'faces'
+        key = (name, batch_size, torch.is_inference_mode_enabled())
+        if key not in self._faces_cache:
+            self._faces_cache[key] = getattr(self.render, name).expand(batch_size, -1, -1).contiguous()
+        return self._faces_cache[key]
+
+    def _detail_input(self, pose, exp, detail):
+        ''' Condition of D_detail: [jaw pose, exp, detail]
+        without autograd it is written into a buffer reused across calls instead of a new torch.cat
+        '''
+        if torch.is_grad_enabled():
+            return torch.cat([pose[:,3:], exp, detail], dim=1)
+        batch_size, n_exp = exp.shape
+        buf = self._detail_input_buf
+        # an inference-mode buffer can not be written outside inference mode, reallocate when the mode changes
+        if buf is None or buf.shape[0] < batch_size or buf.shape[1] != 3+n_exp+detail.shape[1] or buf.device != detail.device \
+                or buf.is_inference() != torch.is_inference_mode_enabled():
+            buf = torch.empty([batch_size, 3+n_exp+detail.shape[1]], dtype=detail.dtype, device=detail.device)
+            self._detail_input_buf = buf
+        buf = buf[:batch_size]
+        buf[:, :3].copy_(pose[:,3:])
+        buf[:, 3:3+n_exp].copy_(exp)
+        buf[:, 3+n_exp:].copy_(detail)
+        return buf
+
+    def _ones_like(self, x):
+        ''' Tensor of ones matching x, reused across calls while shape, dtype, device and inference mode stay the same
+        '''
+        cache = self._ones_cache
+        if cache is None or cache.shape != x.shape or cache.dtype != x.dtype or cache.device != x.device \
+                or cache.is_inference() != torch.is_inference_mode_enabled():
+            self._ones_cache = torch.ones_like(x)
+        return self._ones_cache
 
-    def decompose_code(self, code, num_dict):
+    def decompose_code(self, code, num_dict=None):
         ''' Convert a flattened parameter vector to a dictionary of parameters
         code_dict.keys() = ['shape', 'tex', 'exp', 'pose', 'cam', 'light']
+        num_dict defaults to the parameter layout fixed in _create_model
         '''
+        if num_dict is None:
+            keys, split_sizes = self._param_keys, self._split_sizes
+        else:
+            keys, split_sizes = list(num_dict.keys()), [int(num_dict[key]) for key in num_dict]
+        # plain slices rather than torch.split: callers write into these in place (e.g. the euler jaw pose in encode),
+        # which autograd rejects for the multi-output views torch.split returns
         code_dict = {}
         start = 0
-        for key in num_dict:
-            end = start+int(num_dict[key])
-            code_dict[key] = code[:, start:end]
-            start = end
-            if key == 'light':
-                code_dict[key] = code_dict[key].reshape(code_dict[key].shape[0], 9, 3)
+        for key, size in zip(keys, split_sizes):
+            code_dict[key] = code[:, start:start+size]
+            start = start + size
+        if 'light' in code_dict:
+            code_dict['light'] = code_dict['light'].reshape(code.shape[0], 9, 3)
         return code_dict
 
-    def displacement2normal(self, uv_z, coarse_verts, coarse_normals):
+    def displacement2normal(self, uv_z, coarse_verts, coarse_normals, upsample=True):
         ''' Convert displacement map into detail normal map
+        upsample: resize to uv_size, otherwise the map is returned at uv_size_coarse
         '''
         batch_size = uv_z.shape[0]
         uv_coarse_vertices = self.render.world2uv(coarse_verts, coarse=True).detach()
@@ -132,11 +319,12 @@ class DECA(nn.Module):
         uv_detail_vertices = uv_coarse_vertices + uv_z*uv_coarse_normals + self.fixed_uv_dis[None,None,:,:]*uv_coarse_normals.detach()
 
         dense_vertices = uv_detail_vertices.permute(0,2,3,1).reshape([batch_size, -1, 3])
-        uv_detail_normals = util.vertex_normals(dense_vertices, self.render.dense_faces.expand(batch_size, -1, -1))
+        uv_detail_normals = util.vertex_normals(dense_vertices, self._faces(batch_size, dense=True))
         uv_detail_normals = uv_detail_normals.reshape([batch_size, uv_coarse_vertices.shape[2], uv_coarse_vertices.shape[3], 3]).permute(0,3,1,2)
 
         uv_detail_normals = uv_detail_normals*self.uv_face_eye_mask_coarse + uv_coarse_normals*(1-self.uv_face_eye_mask_coarse)
-        uv_detail_normals = F.interpolate(uv_detail_normals, (self.uv_size, self.uv_size))
+        if upsample:
+            uv_detail_normals = F.interpolate(uv_detail_normals, (self.uv_size, self.uv_size))
 
         return uv_detail_normals
 
@@ -147,19 +335,63 @@ class DECA(nn.Module):
         vis68 = (normals68[:,:,2:] < 0.1).float()
         return vis68
 
+    @torch.no_grad()
+    def capture_graph(self, images):
+        ''' Capture the encoder forward as a CUDA graph
+        later calls to encode with images of the same shape replay the graph instead of launching every kernel
+        returns False (and encode keeps running eagerly) when this torch build can not capture graphs or use_amp is set
+        '''
+        if torch.version.cuda is None or int(torch.version.cuda.split('.')[0]) < 11:
+            print(f'CUDA graphs need pytorch built with CUDA >= 11.0, found {torch.version.cuda}; encoders run eagerly')
+            return False
+        if self.cfg.model.use_amp:
+            # autocast frees its fp16 weight copies when the block exits, a replay would then read freed memory
+            print('CUDA graphs are not captured with use_amp; encoders run eagerly')
+            return False
+        self._static_images = images.contiguous(memory_format=torch.channels_last).clone(memory_format=torch.channels_last)
+        stream = torch.cuda.Stream()
+        stream.wait_stream(torch.cuda.current_stream())
+        with torch.cuda.stream(stream):
+            # warmup, also lets cudnn.benchmark pick its kernels before capture
+            for _ in range(3):
+                self.E_flame(self._static_images)
+                self.E_detail(self._static_images)
+            self._graph = torch.cuda.CUDAGraph()
+            self._graph.capture_begin()
+            self._static_parameters = self.E_flame(self._static_images)
+            self._static_detailcode = self.E_detail(self._static_images)
+            self._graph.capture_end()
+        torch.cuda.current_stream().wait_stream(stream)
+        return True
+
+    def replay(self, images):
+        ''' Run the captured encoder graph on new images, returns (parameters, detailcode)
+        '''
+        self._static_images.copy_(images)
+        self._graph.replay()
+        # outputs live in the graph's static memory and are overwritten by the next replay
+        return self._static_parameters.clone(), self._static_detailcode.clone()
+
     # @torch.no_grad()
     def encode(self, images, use_detail=True):
-        if use_detail:
-            # use_detail is for training detail model, need to set coarse model as eval mode
-            with torch.no_grad():
-                parameters = self.E_flame(images)
-        else:
-            parameters = self.E_flame(images)
-        codedict = self.decompose_code(parameters, self.param_dict)
+        # the encoders run in channels_last, codedict keeps the images as given
+        images_cl = images.contiguous(memory_format=torch.channels_last)
+        with torch.cuda.amp.autocast(enabled=self.cfg.model.use_amp):
+            # the graph outputs are detached clones, only replay when no gradient is needed
+            if use_detail and self._graph is not None and not torch.is_grad_enabled() and images.shape == self._static_images.shape:
+                parameters, detailcode = self.replay(images_cl)
+            elif use_detail:
+                # use_detail is for training detail model, need to set coarse model as eval mode
+                with torch.no_grad():
+                    parameters = self.E_flame(images_cl)
+                detailcode = self.E_detail(images_cl)
+            else:
+                parameters = self.E_flame(images_cl)
+        # FLAME and the renderer stay in fp32
+        codedict = self.decompose_code(parameters.float())
         codedict['images'] = images
         if use_detail:
-            detailcode = self.E_detail(images)
-            codedict['detail'] = detailcode
+            codedict['detail'] = detailcode.float()
         if self.cfg.model.jaw_type == 'euler':
             posecode = codedict['pose']
             euler_jaw_pose = posecode[:,3:].clone() # x for yaw (open mouth), y for pitch (left ang right), z for roll
@@ -176,33 +408,39 @@ class DECA(nn.Module):
         
         ## decode
         verts, landmarks2d, landmarks3d, freeze_eyes = self.flame(shape_params=codedict['shape'], expression_params=codedict['exp'], pose_params=codedict['pose'], pca_index=pca_index, pca_scale=pca_scale, all_scale=all_scale, freeze_eyes=freeze_eyes)
-        if self.cfg.model.use_tex:
+        if self.cfg.model.use_tex and 'albedo' in codedict:
+            # texture code is fixed across repeated decodes, reuse the albedo of a previous call
+            albedo = codedict['albedo']
+        elif self.cfg.model.use_tex:
             albedo = self.flametex(codedict['tex'])
         else:
-            albedo = torch.zeros([batch_size, 3, self.uv_size, self.uv_size], device=images.device) 
-        landmarks3d_world = landmarks3d.clone()
+            albedo = self._zero_albedo.expand(batch_size, -1, -1, -1)
 
         ## projection
-        trans_verts = util.batch_orth_proj(verts, codedict['cam']); trans_verts[:,:,1:] = -trans_verts[:,:,1:]
+        trans_verts = _project(verts, codedict['cam'], self._flip_sign)
 
         opdict = {
             'verts': verts,
             'trans_verts': trans_verts,
             'freeze_eyes': freeze_eyes,
         }
+        if self.cfg.model.use_tex:
+            opdict['albedo'] = albedo
 
         ## rendering
         if rendering:
-            uv_z = self.D_detail(torch.cat([codedict['pose'][:,3:], codedict['exp'], codedict['detail']], dim=1))
-            if iddict is not None:
-                uv_z = self.D_detail(torch.cat([iddict['pose'][:,3:], iddict['exp'], codedict['detail']], dim=1))
-
-            normals = util.vertex_normals(verts, self.render.faces.expand(batch_size, -1, -1))
-            uv_detail_normals = self.displacement2normal(uv_z, verts, normals)
-            uv_shading = self.render.add_SHlight(uv_detail_normals, codedict['light'])
-            uv_texture = albedo*uv_shading
+            # jaw pose and expression come from iddict when given
+            posedict = codedict if iddict is None else iddict
+            with torch.cuda.amp.autocast(enabled=self.cfg.model.use_amp):
+                uv_z = self.D_detail(self._detail_input(posedict['pose'], posedict['exp'], codedict['detail']))
+            uv_z = uv_z.float()
+
+            normals = util.vertex_normals(verts, self._faces(batch_size))
+            # shading is a per-pixel function of the normal and the upsampling is nearest,
+            # so shading at uv_size_coarse and then upsampling gives the same result for 1/16 of the work
+            uv_detail_normals = self.displacement2normal(uv_z, verts, normals, upsample=False)
+            uv_shading = F.interpolate(self.render.add_SHlight(uv_detail_normals, codedict['light']), (self.uv_size, self.uv_size))
 
-            opdict['uv_texture'] = uv_texture 
             opdict['normals'] = normals
             opdict['uv_detail_normals'] = uv_detail_normals
             opdict['displacement_map'] = uv_z+self.fixed_uv_dis[None,None,:,:]
@@ -212,21 +450,24 @@ class DECA(nn.Module):
             else:
                 uv_pverts = self.render.world2uv(trans_verts)
                 # store attributes for transfer
-                face_vertices = util.face_vertices(trans_verts, self.render.faces.expand(trans_verts.shape[0], -1, -1))
+                face_vertices = util.face_vertices(trans_verts, self._faces(trans_verts.shape[0]))
                 opdict['attributes'] = face_vertices
 
-            uv_gt = F.grid_sample(hr_images, uv_pverts.permute(0,2,3,1)[:,:,:,:2], mode='bilinear', align_corners=False)
-            uv_gt_mask = F.grid_sample(torch.ones_like(hr_images), uv_pverts.permute(0,2,3,1)[:,:,:,:2], mode='bilinear', align_corners=False)[:, [0], ...]
+            uv_grid = uv_pverts.permute(0,2,3,1)[:,:,:,:2]
+            uv_gt = F.grid_sample(hr_images, uv_grid, mode='bilinear', align_corners=False)
+            # every channel of the sampled ones is identical, so a single channel is enough for the mask
+            uv_gt_mask = F.grid_sample(self._ones_like(hr_images[:, :1]), uv_grid, mode='bilinear', align_corners=False)
 
             if self.cfg.model.use_tex:
                 # inpaint any missing texture regions
                 # uv_gt[uv_gt_mask==0] = uv_texture[uv_gt_mask==0]
-                uv_face_eye_mask = self.uv_face_eye_mask * uv_gt_mask
                 # combined
-                uv_texture_gt = uv_gt[:,:3,:,:]*uv_face_eye_mask + (uv_texture[:,:3,:,:]*(1-uv_face_eye_mask))
+                uv_texture, uv_face_eye_mask, uv_texture_gt = _shade_and_blend(albedo, uv_shading, uv_gt, self.uv_face_eye_mask, uv_gt_mask)
             else:
                 uv_face_eye_mask = self.uv_face_eye_mask * uv_gt_mask
+                uv_texture = albedo*uv_shading
                 uv_texture_gt = uv_gt[:,:3,:,:]
+            opdict['uv_texture'] = uv_texture
             opdict['uv_texture_gt'] = uv_texture_gt
 
         if return_vis:
@@ -260,16 +501,22 @@ class DECA(nn.Module):
         
         ## decode
         verts, landmarks2d, landmarks3d, _ = self.flame(shape_params=codedict['shape'], expression_params=codedict['exp'], pose_params=codedict['pose'])
-        if self.cfg.model.use_tex:
+        if self.cfg.model.use_tex and 'albedo' in codedict:
+            # texture code is fixed across repeated decodes, reuse the albedo of a previous call
+            albedo = codedict['albedo']
+        elif self.cfg.model.use_tex:
             albedo = self.flametex(codedict['tex'])
         else:
-            albedo = torch.zeros([batch_size, 3, self.uv_size, self.uv_size], device=images.device) 
-        landmarks3d_world = landmarks3d.clone()
+            albedo = self._zero_albedo.expand(batch_size, -1, -1, -1)
+        landmarks3d_world = landmarks3d
 
         ## projection
-        landmarks2d = util.batch_orth_proj(landmarks2d, codedict['cam'])[:,:,:2]; landmarks2d[:,:,1:] = -landmarks2d[:,:,1:]#; landmarks2d = landmarks2d*self.image_size/2 + self.image_size/2
-        landmarks3d = util.batch_orth_proj(landmarks3d, codedict['cam']); landmarks3d[:,:,1:] = -landmarks3d[:,:,1:] #; landmarks3d = landmarks3d*self.image_size/2 + self.image_size/2
-        trans_verts = util.batch_orth_proj(verts, codedict['cam']); trans_verts[:,:,1:] = -trans_verts[:,:,1:]
+        # vertices and both landmark sets are projected together, then sliced apart
+        n_verts, n_lmk2d = verts.shape[1], landmarks2d.shape[1]
+        points = _project(torch.cat([verts, landmarks2d, landmarks3d], dim=1), codedict['cam'], self._flip_sign)
+        trans_verts = points[:, :n_verts]
+        landmarks2d = points[:, n_verts:n_verts+n_lmk2d, :2]#; landmarks2d = landmarks2d*self.image_size/2 + self.image_size/2
+        landmarks3d = points[:, n_verts+n_lmk2d:] #; landmarks3d = landmarks3d*self.image_size/2 + self.image_size/2
 
         opdict = {
             'verts': verts,
@@ -281,16 +528,19 @@ class DECA(nn.Module):
 
         ## rendering
         if rendering:
-            uv_z = self.D_detail(torch.cat([codedict['pose'][:,3:], codedict['exp'], codedict['detail']], dim=1))
-            if iddict is not None:
-                uv_z = self.D_detail(torch.cat([iddict['pose'][:,3:], iddict['exp'], codedict['detail']], dim=1))
-
-            normals = util.vertex_normals(verts, self.render.faces.expand(batch_size, -1, -1))
-            uv_detail_normals = self.displacement2normal(uv_z, verts, normals)
-            uv_shading = self.render.add_SHlight(uv_detail_normals, codedict['light'])
-            uv_texture = albedo*uv_shading
+            # jaw pose and expression come from iddict when given
+            posedict = codedict if iddict is None else iddict
+            with torch.cuda.amp.autocast(enabled=self.cfg.model.use_amp):
+                uv_z = self.D_detail(self._detail_input(posedict['pose'], posedict['exp'], codedict['detail']))
+            uv_z = uv_z.float()
+
+            normals = util.vertex_normals(verts, self._faces(batch_size))
+            # shading is a per-pixel function of the normal and the upsampling is nearest,
+            # so shading at uv_size_coarse and then upsampling gives the same result for 1/16 of the work
+            uv_detail_normals = self.displacement2normal(uv_z, verts, normals, upsample=False)
+            uv_shading = F.interpolate(self.render.add_SHlight(uv_detail_normals, codedict['light']), (self.uv_size, self.uv_size))
+            uv_detail_normals = F.interpolate(uv_detail_normals, (self.uv_size, self.uv_size))
 
-            opdict['uv_texture'] = uv_texture 
             opdict['normals'] = normals
             opdict['uv_detail_normals'] = uv_detail_normals
             opdict['displacement_map'] = uv_z+self.fixed_uv_dis[None,None,:,:]
@@ -300,24 +550,28 @@ class DECA(nn.Module):
             else:
                 uv_pverts = self.render.world2uv(trans_verts)
                 # store attributes for transfer
-                face_vertices = util.face_vertices(trans_verts, self.render.faces.expand(trans_verts.shape[0], -1, -1))
+                face_vertices = util.face_vertices(trans_verts, self._faces(trans_verts.shape[0]))
                 opdict['attributes'] = face_vertices
 
-            uv_gt = F.grid_sample(hr_images, uv_pverts.permute(0,2,3,1)[:,:,:,:2], mode='bilinear', align_corners=False)
-            uv_gt_mask = F.grid_sample(torch.ones_like(hr_images), uv_pverts.permute(0,2,3,1)[:,:,:,:2], mode='bilinear', align_corners=False)
+            uv_grid = uv_pverts.permute(0,2,3,1)[:,:,:,:2]
+            uv_gt = F.grid_sample(hr_images, uv_grid, mode='bilinear', align_corners=False)
+            # every channel of the sampled ones is identical, so a single channel is enough for the mask
+            uv_gt_mask = F.grid_sample(self._ones_like(hr_images[:, :1]), uv_grid, mode='bilinear', align_corners=False)
 
             if self.cfg.model.use_tex:
                 # inpaint any missing texture regions
                 # uv_gt[uv_gt_mask==0] = uv_texture[uv_gt_mask==0]
-                uv_face_eye_mask = self.uv_face_eye_mask * uv_gt_mask
                 # combined
-                uv_texture_gt = uv_gt[:,:3,:,:]*uv_face_eye_mask + (uv_texture[:,:3,:,:]*(1-uv_face_eye_mask))
+                uv_texture, uv_face_eye_mask, uv_texture_gt = _shade_and_blend(albedo, uv_shading, uv_gt, self.uv_face_eye_mask, uv_gt_mask)
             else:
                 uv_face_eye_mask = self.uv_face_eye_mask * uv_gt_mask
+                uv_texture = albedo*uv_shading
                 uv_texture_gt = uv_gt[:,:3,:,:]
+            opdict['uv_texture'] = uv_texture
 
             opdict['uv_texture_gt'] = uv_texture_gt
-            save_image(uv_texture_gt[0].cpu(), "./coarse_uv_texture.png")
+            if self.cfg.debug.save_uv_intermediates:
+                self._save_image_async(uv_texture_gt[0], "./coarse_uv_texture.png")
         
         if self.cfg.model.use_tex:
             opdict['albedo'] = albedo
@@ -358,28 +612,15 @@ class DECA(nn.Module):
             shape_detail_images = self.render.render_shape(verts, trans_verts, detail_normal_images=detail_normal_images, h=h, w=w, images=background)
 
             # Render the detailed mesh.
-            vertices = opdict['verts'][0].cpu().numpy()
-            faces = self.render.faces[0].cpu().numpy()
-            texture = util.tensor2image(opdict['uv_texture_gt'][0])
-            texture = texture[:,:,[2,1,0]]
-            normals = opdict['normals'][0].cpu().numpy()
-
-            displacement_map = opdict['displacement_map'][0].cpu().detach().numpy().squeeze()
-            dense_vertices, dense_colors, dense_faces, dense_uvcoords, dense_uvfaces = util.upsample_mesh(vertices, normals, faces, displacement_map, texture, self.dense_template)
-
-            # Normalize UV coordinates.
-            dense_uvcoords = torch.from_numpy(dense_uvcoords).cuda().unsqueeze(0) / np.max(dense_uvcoords)
-            dense_uvcoords = torch.cat([dense_uvcoords, dense_uvcoords[:,:,0:1]*0.+1.], -1) #[bz, ntv, 3]
-            dense_uvcoords = dense_uvcoords*2 - 1
-            dense_uvfaces = torch.from_numpy(dense_uvfaces).cuda().unsqueeze(0)
+            # the mesh is upsampled on the device, no host round trip for the first item of the batch
+            dense_vertices = util.upsample_mesh_torch(opdict['verts'][:1], opdict['normals'][:1], opdict['displacement_map'][:1, 0], self.dense_mesh)
+            dense_faces = self.dense_mesh['faces']
+            dense_uvcoords = self.dense_mesh['uvcoords']
+            dense_uvfaces = self.dense_mesh['uvfaces']
 
             # Transform vertices.
-            dense_vertices = torch.from_numpy(dense_vertices.astype(np.float32)).unsqueeze(0).cuda()
-            dense_trans_verts = util.batch_orth_proj(dense_vertices, codedict['cam'])
-            dense_trans_verts[:,:,1:] = -dense_trans_verts[:,:,1:]
-            dense_faces = torch.from_numpy(dense_faces).cuda().unsqueeze(0)
+            dense_trans_verts = _project(dense_vertices, codedict['cam'], self._flip_sign)
 
-            detail_normal_images = F.grid_sample(uv_detail_normals, grid, align_corners=False)*alpha_images
             detail_face_uvcoords = util.face_vertices(dense_uvcoords, dense_uvfaces)
 
             # tried this instead of the above code for shape_detail_images, but doesn't seem to matter
@@ -399,7 +640,6 @@ class DECA(nn.Module):
             }
             # if self.cfg.model.use_tex:
             visdict['rendered_images'] = ops['images']
-            visdict['mask'] = ops['mask']
 
 
             if 'dense_attributes' in codedict:
@@ -410,18 +650,20 @@ class DECA(nn.Module):
                 dense_face_vertices = util.face_vertices(dense_trans_verts, dense_faces.expand(dense_vertices.shape[0], -1, -1))
                 opdict['dense_attributes'] = dense_face_vertices
 
-            uv_gt = F.grid_sample(hr_images, uv_pverts.permute(0,2,3,1)[:,:,:,:2], mode='bilinear', align_corners=False)
-            uv_gt_mask = F.grid_sample(torch.ones_like(hr_images), uv_pverts.permute(0,2,3,1)[:,:,:,:2], mode='bilinear', align_corners=False)
+            uv_grid = uv_pverts.permute(0,2,3,1)[:,:,:,:2]
+            uv_gt = F.grid_sample(hr_images, uv_grid, mode='bilinear', align_corners=False)
+            # every channel of the sampled ones is identical, so a single channel is enough for the mask
+            uv_gt_mask = F.grid_sample(self._ones_like(hr_images[:, :1]), uv_grid, mode='bilinear', align_corners=False)
 
             if self.cfg.model.use_tex:
                 # inpaint any missing texture regions
                 # uv_gt[uv_gt_mask==0] = uv_texture[uv_gt_mask==0]
-                uv_face_eye_mask = self.uv_face_eye_mask * uv_gt_mask 
-                uv_texture_gt = uv_gt[:,:3,:,:]*uv_face_eye_mask + (uv_texture[:,:3,:,:]*(1-uv_face_eye_mask))
+                uv_face_eye_mask, uv_texture_gt = _blend_texture(uv_gt, uv_texture, self.uv_face_eye_mask, uv_gt_mask)
             else:
                 uv_face_eye_mask = self.uv_face_eye_mask * uv_gt_mask
                 uv_texture_gt = uv_gt[:,:3,:,:]
-            save_image(uv_texture_gt[0].cpu(), "./dense_uv_texture.png")
+            if self.cfg.debug.save_uv_intermediates:
+                self._save_image_async(uv_texture_gt[0], "./dense_uv_texture.png")
 
             if render_orig and original_image is not None and tform is not None:
                 points_scale = [self.image_size, self.image_size]
@@ -430,7 +672,7 @@ class DECA(nn.Module):
 
             ops = self.render.render_dense(dense_vertices, dense_faces, util.face_vertices(dense_uvcoords, dense_uvfaces), dense_trans_verts, uv_texture_gt, None, h=h, w=w, bg_images=background, face_mask=uv_face_eye_mask)
             visdict['rendered_images_detailed'] = ops['images']
-            visdict['mask_detailed'] = ops['mask']
+            visdict['mask_detailed'] = ops['mask'].repeat(1, 3, 1, 1)
 
             # import matplotlib.pyplot as plt
             # plt.subplot(141)
@@ -447,6 +689,31 @@ class DECA(nn.Module):
         else:
             return opdict
 
+    def _save_image_async(self, image, filename):
+        ''' Save an image tensor without blocking the forward pass
+        the device to host copy is issued on a side stream and the png is written by a worker thread
+        '''
+        if self._io_executor is None:
+            self._io_executor = ThreadPoolExecutor(max_workers=1)
+        image = image.detach()
+        if not image.is_cuda:
+            self._io_executor.submit(save_image, image.clone(), filename)
+            return
+        if self._io_stream is None:
+            self._io_stream = torch.cuda.Stream(device=image.device)
+        self._io_stream.wait_stream(torch.cuda.current_stream())
+        image_cpu = torch.empty(image.shape, dtype=image.dtype, pin_memory=True)
+        with torch.cuda.stream(self._io_stream):
+            image_cpu.copy_(image, non_blocking=True)
+            copied = torch.cuda.Event()
+            copied.record(self._io_stream)
+        # keep the caching allocator from reusing image before the copy has finished
+        image.record_stream(self._io_stream)
+        def _write():
+            copied.synchronize()
+            save_image(image_cpu, filename)
+        self._io_executor.submit(_write)
+
     def visualize(self, visdict, size=224, dim=2):
         '''
         image range should be [0,1]
@@ -496,11 +763,12 @@ class DECA(nn.Module):
                         #colors = dense_colors,
                         inverse_face_order=True)
         """
+    @torch.inference_mode()
     def run(self, imagepath, iscrop=True):
         ''' An api for running deca given an image path
         '''
-        testdata = datasets.TestData(imagepath)
-        images = testdata[0]['image'].to(self.device)[None,...]
+        testdata = datasets.TestData(imagepath, pin_memory='cuda' in str(self.device))
+        images = testdata[0]['image'].to(self.device, non_blocking=True)[None,...]
         codedict = self.encode(images)
         opdict, visdict = self.decode(codedict)
         return codedict, opdict, visdict
@@ -42,6 +42,9 @@ cfg.model.n_cam = 3
 cfg.model.n_pose = 6
 cfg.model.n_light = 27
 cfg.model.use_tex = True
+cfg.model.use_jit = False # trace encoders/detail decoder with TorchScript, inference only
+cfg.model.use_amp = False # run encoders/detail decoder under fp16 autocast
+cfg.model.use_cuda_graph = False # replay the encoders as a CUDA graph, needs torch built with CUDA >= 11.0
 cfg.model.jaw_type = 'aa' # default use axis angle, another option: euler. Note that: aa is not stable in the beginning
 # face recognition model
 cfg.model.fr_model_path = os.path.join(cfg.deca_dir, 'data', 'resnet50_ft_weight.pkl')
@@ -114,6 +117,12 @@ cfg.loss.reg_sym = 0.005
 cfg.loss.reg_z = 0.005
 cfg.loss.reg_diff = 0.005
 
+# ---------------------------------------------------------------------------- #
+# Options for debugging
+# ---------------------------------------------------------------------------- #
+cfg.debug = CN()
+cfg.debug.save_uv_intermediates = False # write coarse/dense uv textures from decode to the working directory
+
 
 def get_cfg_defaults():
     """Get a yacs CfgNode object with default values for my_project."""
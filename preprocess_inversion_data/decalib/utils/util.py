@@ -27,6 +27,7 @@ import torchvision
 def upsample_mesh(vertices, normals, faces, displacement_map, texture_map, dense_template):
     ''' Credit to Timo
     upsampling coarse mesh (with displacment map)
+    numpy reference for upsample_mesh_torch, currently unused (the detailed mesh export in DECA.save_obj is disabled)
         vertices: vertices of coarse mesh, [nv, 3]
         normals: vertex normals, [nv, 3]
         faces: faces of coarse mesh, [nf, 3]
@@ -68,6 +69,31 @@ def upsample_mesh(vertices, normals, faces, displacement_map, texture_map, dense
 
     return dense_vertices, dense_colors, dense_faces, dense_uv_coords, dense_uvfaces
 
+def upsample_mesh_torch(vertices, normals, displacement_map, dense_template):
+    ''' Tensor version of upsample_mesh, stays on the device of its inputs
+        vertices: vertices of coarse mesh, [bz, nv, 3]
+        normals: vertex normals, [bz, nv, 3]
+        displacement_map: displacment map, [bz, 256, 256]
+        dense_template: 'valid_pixel_3d_faces', 'valid_pixel_b_coords', 'x_ids', 'y_ids' as tensors
+    Returns: 
+        dense_vertices: upsampled vertices with details, [bz, number of dense vertices, 3]
+    '''
+    valid_pixel_3d_faces = dense_template['valid_pixel_3d_faces']
+    valid_pixel_b_coords = dense_template['valid_pixel_b_coords'][None,:,:,None]
+
+    pixel_3d_points = (vertices[:, valid_pixel_3d_faces] * valid_pixel_b_coords).sum(2)
+    pixel_3d_normals = (normals[:, valid_pixel_3d_faces] * valid_pixel_b_coords).sum(2)
+    pixel_3d_normals = pixel_3d_normals / torch.norm(pixel_3d_normals, dim=-1, keepdim=True)
+    displacements = displacement_map[:, dense_template['y_ids'], dense_template['x_ids']]
+    dense_vertices = pixel_3d_points + displacements[:,:,None]*pixel_3d_normals
+    return dense_vertices
+
+def load_dense_template(dense_template_path):
+    ''' Load the pickled dense mesh template (texture_data_*.npy) as a dict of plain numpy arrays
+    '''
+    dense_template = np.load(dense_template_path, allow_pickle=True, encoding='latin1').item()
+    return {key: np.asarray(value) for key, value in dense_template.items()}
+
 # borrowed from https://github.com/YadiraF/PRNet/blob/master/utils/write.py
 def write_obj(obj_name,
               vertices,
@@ -276,12 +302,13 @@ def vertex_normals(vertices, faces):
     faces = faces.reshape(-1, 3)
     vertices_faces = vertices_faces.reshape(-1, 3, 3)
 
-    normals.index_add_(0, faces[:, 1].long(), 
-                       torch.cross(vertices_faces[:, 2] - vertices_faces[:, 1], vertices_faces[:, 0] - vertices_faces[:, 1]))
-    normals.index_add_(0, faces[:, 2].long(), 
-                       torch.cross(vertices_faces[:, 0] - vertices_faces[:, 2], vertices_faces[:, 1] - vertices_faces[:, 2]))
-    normals.index_add_(0, faces[:, 0].long(),
-                       torch.cross(vertices_faces[:, 1] - vertices_faces[:, 0], vertices_faces[:, 2] - vertices_faces[:, 0]))
+    # the three per-corner cross products are cyclic permutations of the same face normal,
+    # so compute it once and scatter it to every corner
+    face_normals = torch.cross(vertices_faces[:, 1] - vertices_faces[:, 0], vertices_faces[:, 2] - vertices_faces[:, 0], dim=1)
+    faces = faces.long()
+    normals.index_add_(0, faces[:, 0], face_normals)
+    normals.index_add_(0, faces[:, 1], face_normals)
+    normals.index_add_(0, faces[:, 2], face_normals)
 
     normals = F.normalize(normals, eps=1e-6, dim=1)
     normals = normals.reshape((bs, nv, 3))
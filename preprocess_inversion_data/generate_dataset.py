@@ -27,41 +27,58 @@ from decalib.datasets import datasets
 from decalib.utils import util
 from decalib.utils.config import cfg as deca_cfg
 
+@torch.inference_mode()
 def main(args):
     savefolder = args.savefolder
     device = args.device
     os.makedirs(savefolder, exist_ok=True)
 
     # load test images
-    testdata = datasets.TestData(args.image_path, iscrop=args.iscrop, face_detector=args.detector)
-    expdata = datasets.TestData(args.exp_path, iscrop=args.iscrop, face_detector=args.detector)
+    pin_memory = 'cuda' in device
+    testdata = datasets.TestData(args.image_path, iscrop=args.iscrop, face_detector=args.detector, pin_memory=pin_memory)
+    expdata = datasets.TestData(args.exp_path, iscrop=args.iscrop, face_detector=args.detector, pin_memory=pin_memory)
 
     # run DECA
     deca_cfg.model.use_tex = args.useTex
+    deca_cfg.model.use_jit = args.useJit
+    deca_cfg.model.use_amp = args.useAmp
+    deca_cfg.model.use_cuda_graph = args.useCudaGraph
     deca_cfg.rasterizer_type = args.rasterizer_type
     deca = DECA(config = deca_cfg, device=device)
 
-    # target reference
-    name = testdata[0]['imagename']
+    # target reference, loaded (face detection + warps) and encoded once for all frames
+    target = testdata[0]
+    name = target['imagename']
     savepath = '{}/{}.jpg'.format(savefolder, name)
-    with torch.no_grad():
-        images = testdata[0]['image'].to(device)[None,...]
-        id_codedict = deca.encode(images)
+    images = target['image'].to(device, non_blocking=True)[None,...]
+    id_codedict = deca.encode(images)
     
-    id_codedict['hr_images'] = testdata[0]['hr_image'].to(device)[None,...]
+    id_codedict['hr_images'] = target['hr_image'].to(device, non_blocking=True)[None,...]
     id_opdict, id_visdict = deca.decode_coarse(id_codedict, pca_scale=1, all_scale=1)
+    # only pose and expression change per frame, keep everything derived from the target fixed
     id_codedict['attributes'] = id_opdict['attributes']
+    if 'albedo' in id_opdict:
+        id_codedict['albedo'] = id_opdict['albedo']
+    tform = target['tform'][None, ...]
+    tform = torch.inverse(tform).transpose(1,2).to(device)
+    original_image = target['original_image'][None, ...].to(device, non_blocking=True)
 
     all_poses = []
     all_exps = []
 
+    # first frame is loaded once, for the graph capture and the first iteration
+    first_exp_images = expdata[0]['image'].to(device, non_blocking=True)[None,...]
+    # every expression frame is encoded with the same input shape
+    if deca_cfg.model.use_cuda_graph and 'cuda' in device and len(expdata) > 1:
+        deca.capture_graph(first_exp_images)
+
     for i in range(0, len(expdata)):
         # source reference
-        with torch.no_grad():
-            exp_images = expdata[i]['image'].to(device)[None,...]
-            exp_codedict = deca.encode(exp_images)
-            all_poses.append(exp_codedict['pose'][:,3:])
-            all_exps.append(exp_codedict['exp'])
+        # the copy is queued behind the previous frame's encoder, while the cpu moves on to load the next frame
+        exp_images = first_exp_images if i == 0 else expdata[i]['image'].to(device, non_blocking=True)[None,...]
+        exp_codedict = deca.encode(exp_images)
+        all_poses.append(exp_codedict['pose'][:,3:])
+        all_exps.append(exp_codedict['exp'])
     all_poses = torch.stack(all_poses, 0)
     all_exps = torch.stack(all_exps, 0)
 
@@ -82,24 +99,19 @@ def main(args):
         smooth_exps = all_exps
 
     for i in range(0, len(expdata)):
-        name = testdata[0]['imagename'] + "_" + str(i).zfill(3)
+        name = target['imagename'] + "_" + str(i).zfill(3)
         print("processing:", i, "/", len(expdata))
 
         # source reference
         id_codedict['pose'][:,3:] = smooth_poses[i]
         id_codedict['exp'] = smooth_exps[i]
 
-        with torch.no_grad():
-            tform = testdata[0]['tform'][None, ...]
-            tform = torch.inverse(tform).transpose(1,2).to(device)
-            original_image = testdata[0]['original_image'][None, ...].to(device)
-            
-            if args.scale_expressions:
-                orig_opdict, orig_visdict = deca.decode_coarse(id_codedict, render_orig=True, original_image=original_image, tform=tform, pca_index=9, pca_scale=1, all_scale=2, freeze_eyes=id_opdict['freeze_eyes'])
-            else:
-                orig_opdict, orig_visdict = deca.decode_coarse(id_codedict, render_orig=True, original_image=original_image, tform=tform, pca_index=9, pca_scale=1, all_scale=1, freeze_eyes=id_opdict['freeze_eyes'])
+        if args.scale_expressions:
+            orig_opdict, orig_visdict = deca.decode_coarse(id_codedict, render_orig=True, original_image=original_image, tform=tform, pca_index=9, pca_scale=1, all_scale=2, freeze_eyes=id_opdict['freeze_eyes'])
+        else:
+            orig_opdict, orig_visdict = deca.decode_coarse(id_codedict, render_orig=True, original_image=original_image, tform=tform, pca_index=9, pca_scale=1, all_scale=1, freeze_eyes=id_opdict['freeze_eyes'])
 
-            orig_visdict['inputs'] = original_image  
+        orig_visdict['inputs'] = original_image  
 
         depth_image = deca.render.render_depth(orig_opdict['trans_verts']).repeat(1,3,1,1)
         orig_visdict['depth_images'] = depth_image
@@ -141,6 +153,15 @@ if __name__ == '__main__':
                         help='whether to use FLAME texture model to generate uv texture map, \
                             set it to True only if you downloaded texture model' )
 
+    parser.add_argument('--useJit', default=False, type=lambda x: x.lower() in ['true', '1'],
+                        help='whether to compile the encoders and detail decoder with TorchScript' )
+
+    parser.add_argument('--useAmp', default=False, type=lambda x: x.lower() in ['true', '1'],
+                        help='whether to run the encoders and detail decoder in fp16 autocast' )
+
+    parser.add_argument('--useCudaGraph', default=False, type=lambda x: x.lower() in ['true', '1'],
+                        help='whether to replay the encoders as a CUDA graph, needs pytorch built with CUDA >= 11.0' )
+
     parser.add_argument('--useSmoothing', action='store_true',
                         help='whether to smooth')
 